@@ -1,19 +1,36 @@
 """Claude API client with retry logic"""
 import json
 import logging
+import re
 import time
-from typing import Optional, Dict
+from functools import lru_cache
+from typing import Any, Callable, Optional, Dict, List, Tuple
 
 import requests
 
+from utils.deadline import Deadline
+
+# A single-brace format field such as {harmful}; doubled braces are literals
+_FORMAT_FIELD_RE = re.compile(r"(?<!\{)\{\w+\}(?!\})")
+
+# Shortest prompt prefix the API caches for the Sonnet models used here
+_MIN_CACHEABLE_TOKENS = 1024
+# Low estimate of characters per token, so the length check errs towards caching
+_MIN_CHARS_PER_TOKEN = 3
+
 
 class ClaudeAPIClient:
     """Claude API client with retry logic and error handling"""
 
-    def __init__(self, api_key: str, api_url: str, max_retries: int = 3):
+    def __init__(self, api_key: str, api_url: str, max_retries: int = 3,
+                 prompt_caching: bool = True, batch_poll_interval: float = 30.0):
         self.api_key = api_key
         self.api_url = api_url
         self.max_retries = max_retries
+        self.prompt_caching = prompt_caching
+        self.batch_poll_interval = batch_poll_interval
+        self.usage_log: List[Dict] = []
+        self._uncacheable_templates = set()
         self.logger = logging.getLogger(__name__)
         self.session = requests.Session()
         self.session.headers.update({
@@ -22,27 +39,133 @@ class ClaudeAPIClient:
             "anthropic-version": "2023-06-01",
         })
 
-    def call_with_retry(self,
-                        payload: Dict,
-                        interval: float = 2.0) -> Optional[Dict]:
-        """Call API with exponential backoff retry"""
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _split_template(template: str) -> Tuple[str, str]:
+        """Split a template into a static prefix and the suffix holding its fields
+
+        The split happens at the start of the line containing the first format
+        field, and the prefix is returned already unescaped.
+        """
+        match = _FORMAT_FIELD_RE.search(template)
+        if not match:
+            return template.format(), ""
+        split_at = template.rfind("\n", 0, match.start()) + 1
+        return template[:split_at].format(), template[split_at:]
+
+    def _cacheable_split(self, template: str) -> Optional[Tuple[str, str]]:
+        """Template prefix and suffix when the prefix is long enough for the API to cache
+
+        Prefixes under the minimum cacheable length are never cached, so they
+        are sent without cache_control and a warning is logged once per template.
+        The current PAIR_FINDING, COT_PAIR_FINDING and TRUNCATE prefixes are
+        all well under the minimum.
+        """
+        prefix, suffix = self._split_template(template)
+        if not prefix:
+            return None
+
+        max_tokens = len(prefix) // _MIN_CHARS_PER_TOKEN
+        if max_tokens < _MIN_CACHEABLE_TOKENS:
+            if template not in self._uncacheable_templates:
+                self._uncacheable_templates.add(template)
+                self.logger.warning(f"Template prefix of at most ~{max_tokens} tokens is below the "
+                                    f"{_MIN_CACHEABLE_TOKENS}-token minimum for prompt caching, "
+                                    f"sending it uncached")
+            return None
+        return prefix, suffix
+
+    def _build_payload(self, model: str, max_tokens: int, template: str, **fields) -> Dict:
+        """Build a single user message payload, marking a cacheable template prefix"""
+        split = self._cacheable_split(template) if self.prompt_caching else None
+        if split is None:
+            content = template.format(**fields)
+        else:
+            prefix, suffix = split
+            content = [
+                {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": suffix.format(**fields)},
+            ]
+
+        return {
+            "model": model,
+            "max_tokens": max_tokens,
+            "messages": [{"role": "user", "content": content}]
+        }
+
+    def _record_usage(self, stage: str, response: Dict):
+        """Record token usage, including prompt cache reads and writes, for one call"""
+        usage = response.get("usage") or {}
+        entry = {
+            "stage": stage,
+            "input_tokens": usage.get("input_tokens", 0),
+            "output_tokens": usage.get("output_tokens", 0),
+            "cache_creation_input_tokens": usage.get("cache_creation_input_tokens") or 0,
+            "cache_read_input_tokens": usage.get("cache_read_input_tokens") or 0,
+        }
+        self.usage_log.append(entry)
+        self.logger.debug(f"{stage} usage: {entry['input_tokens']} input, "
+                          f"{entry['cache_read_input_tokens']} cache read, "
+                          f"{entry['cache_creation_input_tokens']} cache write, "
+                          f"{entry['output_tokens']} output tokens")
+
+    def get_usage_summary(self) -> Dict:
+        """Total token usage across all recorded calls"""
+        summary = {
+            'calls': len(self.usage_log),
+            'input_tokens': 0,
+            'output_tokens': 0,
+            'cache_creation_input_tokens': 0,
+            'cache_read_input_tokens': 0,
+        }
+        for entry in self.usage_log:
+            for key in summary:
+                if key != 'calls':
+                    summary[key] += entry[key]
+        return summary
+
+    def _request_with_retry(self,
+                            method: str,
+                            url: str,
+                            parse: Callable[[requests.Response], Any],
+                            interval: float = 2.0,
+                            deadline: Optional[Deadline] = None,
+                            **kwargs) -> Optional[Any]:
+        """Send an HTTP request with exponential backoff retry and parse the response
+
+        With a deadline, each request timeout and backoff wait is capped by the
+        time left, and no further attempts are made once it has expired.
+        """
 
         for attempt in range(self.max_retries):
             try:
                 if attempt > 0:
                     wait_time = interval * (2 ** (attempt - 1))  # Exponential backoff
+                    remaining = deadline.remaining() if deadline else None
+                    if remaining is not None and remaining <= wait_time:
+                        self.logger.warning("Not retrying API call, deadline would expire during backoff")
+                        break
                     self.logger.info(f"Retrying API call (attempt {attempt + 1}/{self.max_retries}) "
                                      f"after {wait_time}s...")
                     time.sleep(wait_time)
 
-                response = self.session.post(
-                    self.api_url,
-                    json=payload,
-                    timeout=30
+                timeout = 30
+                remaining = deadline.remaining() if deadline else None
+                if remaining is not None:
+                    if remaining == 0:
+                        self.logger.warning("Skipping API call, deadline expired")
+                        break
+                    timeout = min(timeout, remaining)
+
+                response = self.session.request(
+                    method,
+                    url,
+                    timeout=timeout,
+                    **kwargs
                 )
                 response.raise_for_status()
 
-                data = response.json()
+                data = parse(response)
                 self.logger.info(f"API call successful on attempt {attempt + 1}")
                 return data
 
@@ -56,57 +179,153 @@ class ClaudeAPIClient:
         self.logger.error(f"All {self.max_retries} API attempts failed")
         return None
 
+    def call_with_retry(self,
+                        payload: Dict,
+                        interval: float = 2.0,
+                        stage: str = "api",
+                        deadline: Optional[Deadline] = None) -> Optional[Dict]:
+        """Call API with exponential backoff retry"""
+        data = self._request_with_retry("POST", self.api_url, lambda r: r.json(), interval,
+                                        deadline=deadline, json=payload)
+        if data:
+            self._record_usage(stage, data)
+        return data
+
+    @property
+    def batches_url(self) -> str:
+        """Message Batches endpoint next to the configured messages endpoint"""
+        return f"{self.api_url.rstrip('/')}/batches"
+
+    def run_batch(self,
+                  payloads: Dict[str, Dict],
+                  stage: str = "api",
+                  interval: float = 2.0) -> Dict[str, Optional[Dict]]:
+        """Submit payloads as one message batch, poll until it ends and collect the results
+
+        Keys of ``payloads`` are used as batch custom ids. Requests that failed,
+        errored or expired map to None, like a failed synchronous call.
+        """
+        results: Dict[str, Optional[Dict]] = {custom_id: None for custom_id in payloads}
+        if not payloads:
+            return results
+
+        batch = self._request_with_retry(
+            "POST", self.batches_url, lambda r: r.json(), interval,
+            json={"requests": [{"custom_id": custom_id, "params": payload}
+                               for custom_id, payload in payloads.items()]}
+        )
+        if not batch:
+            self.logger.error(f"Failed to submit {stage} batch of {len(payloads)} requests")
+            return results
+
+        batch_id = batch["id"]
+        self.logger.info(f"Submitted {stage} batch {batch_id} with {len(payloads)} requests")
+
+        while batch.get("processing_status") != "ended":
+            time.sleep(self.batch_poll_interval)
+            batch = self._request_with_retry(
+                "GET", f"{self.batches_url}/{batch_id}", lambda r: r.json(), interval
+            )
+            if not batch:
+                self.logger.error(f"Lost track of {stage} batch {batch_id}")
+                return results
+            self.logger.debug(f"Batch {batch_id} status: {batch.get('processing_status')}, "
+                              f"counts: {batch.get('request_counts')}")
+
+        results_text = self._request_with_retry(
+            "GET", batch["results_url"], lambda r: r.text, interval
+        )
+        if results_text is None:
+            self.logger.error(f"Failed to download results for {stage} batch {batch_id}")
+            return results
+
+        for line in results_text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            result = item.get("result", {})
+            if result.get("type") == "succeeded":
+                self._record_usage(stage, result["message"])
+                results[item["custom_id"]] = result["message"]
+            else:
+                self.logger.warning(f"Batch request {item.get('custom_id')} {result.get('type')}: "
+                                    f"{result.get('error')}")
+
+        return results
+
+    def _safe_equivalents_payload(self, harmful_prompt: str, rejected_cot: str,
+                                  template: str) -> Dict:
+        return self._build_payload(
+            "claude-3-7-sonnet-20250219", 512, template,
+            harmful=harmful_prompt, reason=rejected_cot
+        )
+
+    def _cot_safe_equivalents_payload(self, harmful_prompt: str, safe_prompt: str,
+                                      safe_cot: str, template: str) -> Dict:
+        return self._build_payload(
+            "claude-3-7-sonnet-20250219", 512, template,
+            safe=safe_prompt, harmful=harmful_prompt, safe_cot=safe_cot
+        )
+
+    def _truncate_cot_payload(self, cot: str, template: str) -> Dict:
+        return self._build_payload("claude-sonnet-4-20250514", 4096, template, COT=cot)
+
     def get_safe_equivalents(self, harmful_prompt: str, rejected_cot: str,
-                             template: str) -> Optional[Dict]:
+                             template: str, deadline: Optional[Deadline] = None) -> Optional[Dict]:
         """Get safe equivalents for a harmful prompt"""
-        payload = {
-            "model": "claude-3-7-sonnet-20250219",
-            "max_tokens": 512,
-            "messages": [
-                {"role": "user",
-                 "content": template.format(harmful=harmful_prompt, reason=rejected_cot)}
-            ]
-        }
+        payload = self._safe_equivalents_payload(harmful_prompt, rejected_cot, template)
 
-        response = self.call_with_retry(payload)
+        response = self.call_with_retry(payload, stage="safe_equivalents", deadline=deadline)
         if not response:
             return None
 
         return self._parse_json_response(response)
 
+    def get_safe_equivalents_bulk(self, items: Dict[str, Tuple[str, str]],
+                                  template: str) -> Dict[str, Optional[Dict]]:
+        """Get safe equivalents for many (harmful_prompt, rejected_cot) pairs in one batch"""
+        payloads = {key: self._safe_equivalents_payload(harmful, cot, template)
+                    for key, (harmful, cot) in items.items()}
+        responses = self.run_batch(payloads, stage="safe_equivalents")
+        return {key: self._parse_json_response(response) if response else None
+                for key, response in responses.items()}
+
     def get_cot_safe_equivalents(self, harmful_prompt: str, safe_prompt: str,
-                                 safe_cot: str, template: str) -> Optional[Dict]:
+                                 safe_cot: str, template: str,
+                                 deadline: Optional[Deadline] = None) -> Optional[Dict]:
         """Get safe equivalents for chain of thought"""
-        payload = {
-            "model": "claude-3-7-sonnet-20250219",
-            "max_tokens": 512,
-            "messages": [
-                {"role": "user",
-                 "content": template.format(
-                     safe=safe_prompt,
-                     harmful=harmful_prompt,
-                     safe_cot=safe_cot
-                 )}
-            ]
-        }
+        payload = self._cot_safe_equivalents_payload(harmful_prompt, safe_prompt, safe_cot, template)
 
-        response = self.call_with_retry(payload)
+        response = self.call_with_retry(payload, stage="cot_safe_equivalents", deadline=deadline)
         if not response:
             return None
 
         return self._parse_json_response(response)
 
-    def truncate_cot(self, cot: str, template: str) -> str:
+    def get_cot_safe_equivalents_bulk(self, items: Dict[str, Tuple[str, str, str]],
+                                      template: str) -> Dict[str, Optional[Dict]]:
+        """Get CoT safe equivalents for many (harmful_prompt, safe_prompt, safe_cot) triples"""
+        payloads = {key: self._cot_safe_equivalents_payload(harmful, safe, safe_cot, template)
+                    for key, (harmful, safe, safe_cot) in items.items()}
+        responses = self.run_batch(payloads, stage="cot_safe_equivalents")
+        return {key: self._parse_json_response(response) if response else None
+                for key, response in responses.items()}
+
+    def truncate_cot(self, cot: str, template: str, deadline: Optional[Deadline] = None) -> str:
         """Truncate chain of thought"""
-        payload = {
-            "model": "claude-sonnet-4-20250514",
-            "max_tokens": 4096,
-            "messages": [
-                {"role": "user", "content": template.format(COT=cot)}
-            ]
-        }
+        payload = self._truncate_cot_payload(cot, template)
+
+        response = self.call_with_retry(payload, stage="truncate_cot", deadline=deadline)
+        return self._extract_truncated_cot(response, cot)
+
+    def truncate_cot_bulk(self, cots: Dict[str, str], template: str) -> Dict[str, str]:
+        """Truncate many chains of thought in one batch"""
+        payloads = {key: self._truncate_cot_payload(cot, template) for key, cot in cots.items()}
+        responses = self.run_batch(payloads, stage="truncate_cot")
+        return {key: self._extract_truncated_cot(responses[key], cot) for key, cot in cots.items()}
 
-        response = self.call_with_retry(payload)
+    def _extract_truncated_cot(self, response: Optional[Dict], cot: str) -> str:
+        """Extract truncated CoT text, falling back to the original CoT"""
         if not response:
             self.logger.warning("Failed to truncate CoT, returning original")
             return cot
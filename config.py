@@ -19,9 +19,51 @@ class Config:
     API_INTERVAL = float(os.getenv("API_INTERVAL", "2.0"))
     MAX_JUDGER_RETRIES = int(os.getenv("MAX_JUDGER_RETRIES", "10"))
 
-    # hardcoded for now
-    CLAUDE_API_URL = "https://api.anthropic.com/v1/messages"
-    MODEL_ID = "openai/gpt-oss-20b"
+    # Generation Scheduling
+    GEN_MAX_BATCH_TOKENS = int(os.getenv("GEN_MAX_BATCH_TOKENS", "32768"))
+    GEN_MAX_BATCH_SIZE = int(os.getenv("GEN_MAX_BATCH_SIZE", "16"))
+    GEN_BUCKET_SIZE = int(os.getenv("GEN_BUCKET_SIZE", "128"))
+
+    # Speculative Decoding (default, assisted or prompt_lookup)
+    DECODING_MODE = os.getenv("DECODING_MODE", "default")
+    DRAFT_MODEL_ID = os.getenv("DRAFT_MODEL_ID")
+    PROMPT_LOOKUP_NUM_TOKENS = int(os.getenv("PROMPT_LOOKUP_NUM_TOKENS", "10"))
+
+    # Static-shape compiled generation
+    COMPILE_GENERATION = os.getenv("COMPILE_GENERATION", "false").lower() == "true"
+    COMPILE_BUCKETS = [int(b) for b in os.getenv("COMPILE_BUCKETS", "512,1024,2048,4096").split(",")]
+    COMPILE_MAX_NEW_TOKENS = int(os.getenv("COMPILE_MAX_NEW_TOKENS", "2048"))
+
+    # Low-memory / CPU inference (quantization: none, int8 or 4bit; 0 threads = torch default)
+    QUANTIZATION = os.getenv("QUANTIZATION", "none")
+    CPU_NUM_THREADS = int(os.getenv("CPU_NUM_THREADS", "0"))
+    CPU_NUM_INTEROP_THREADS = int(os.getenv("CPU_NUM_INTEROP_THREADS", "0"))
+
+    # Logging (ARTIFACT_LOG receives full prompts/responses; otherwise they are sampled)
+    LOG_JSON = os.getenv("LOG_JSON", "false").lower() == "true"
+    LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+    LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+    ARTIFACT_LOG = os.getenv("ARTIFACT_LOG")
+    ARTIFACT_SAMPLE_EVERY = int(os.getenv("ARTIFACT_SAMPLE_EVERY", "10"))
+    ARTIFACT_MAX_CHARS = int(os.getenv("ARTIFACT_MAX_CHARS", "2000"))
+
+    # Per-prompt wall-clock deadline and per-stage timeout in seconds (0 = no limit)
+    PROMPT_TIMEOUT = float(os.getenv("PROMPT_TIMEOUT", "0"))
+    STAGE_TIMEOUT = float(os.getenv("STAGE_TIMEOUT", "0"))
+
+    REFUSAL_EARLY_STOP = os.getenv("REFUSAL_EARLY_STOP", "true").lower() == "true"
+    # Also stop at refusal decisions in the analysis channel, before the final answer.
+    # Off by default: it also cancels samples that quote the policy and then comply
+    REFUSAL_ANALYSIS_STOP = os.getenv("REFUSAL_ANALYSIS_STOP", "false").lower() == "true"
+
+    # Point CLAUDE_API_URL at a local stub to test without the real API
+    CLAUDE_API_URL = os.getenv("CLAUDE_API_URL", "https://api.anthropic.com/v1/messages")
+    # Only template prefixes of 1024+ tokens are cached; the bundled templates are shorter
+    PROMPT_CACHING = os.getenv("PROMPT_CACHING", "true").lower() == "true"
+    CLAUDE_BATCH_POLL_INTERVAL = float(os.getenv("CLAUDE_BATCH_POLL_INTERVAL", "30.0"))
+
+    # Target model; QUANTIZATION int8/4bit needs a full-precision checkpoint
+    MODEL_ID = os.getenv("MODEL_ID", "openai/gpt-oss-20b")
 
     # Validate required settings
     @classmethod
@@ -30,6 +72,10 @@ class Config:
             raise ValueError("CLAUDE_API_KEY environment variable is required")
         if not cls.OPENAI_API_KEY:
             raise ValueError("OPENAI_API_KEY environment variable is required")
+        if cls.DECODING_MODE == "assisted" and not cls.DRAFT_MODEL_ID:
+            raise ValueError("DRAFT_MODEL_ID is required when DECODING_MODE is 'assisted'")
+        if cls.COMPILE_GENERATION and cls.DECODING_MODE != "default":
+            raise ValueError("COMPILE_GENERATION cannot be combined with speculative decoding")
         return True
 
 
@@ -2,16 +2,23 @@
 import argparse
 import csv
 import logging
+import signal
+from contextlib import contextmanager
 from datetime import datetime
 
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoTokenizer
 
 from api.claude_client import ClaudeAPIClient
 from config import config
+from models.compiled import CompiledGeneration
 from models.judge import StrongRejectJudge
+from models.loader import QUANTIZATION_MODES, configure_threads, load_model
+from models.scheduler import GenerationScheduler
+from models.speculative import DECODING_MODES, SpeculativeDecoder
 from processors.prompt_processor import PromptProcessor
 from utils.csv_handler import ResultsCSVWriter
 from utils.logging_config import setup_logging
+from utils.memory import peak_rss_mb
 from utils.prompt_templates import PromptTemplates
 
 
@@ -55,6 +62,21 @@ def multiline_input() -> str:
     return '\n'.join(lines)
 
 
+@contextmanager
+def cancel_on_interrupt(processor: PromptProcessor):
+    """Make the first Ctrl+C cancel the prompt in progress; a second one interrupts as usual"""
+    def _cancel(signum, frame):
+        signal.signal(signal.SIGINT, previous)
+        print("\nCancelling prompt, press Ctrl+C again to exit...")
+        processor.cancel()
+
+    previous = signal.signal(signal.SIGINT, _cancel)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGINT, previous)
+
+
 def run_interactive_mode(processor: PromptProcessor, csv_writer: ResultsCSVWriter):
     """Run the processor in interactive mode"""
     print("CoT Mirage Interactive Mode with Judge Evaluation")
@@ -82,15 +104,17 @@ def run_interactive_mode(processor: PromptProcessor, csv_writer: ResultsCSVWrite
                 else:
                     print("Please enter a positive integer.")
 
-            # Process the prompt multiple times if requested
-            for i in range(num_runs):
+            print("#" * 80)
+            print(f"\n\n=== Processing prompt ===\n{prompt}\n")
+
+            # Repeated runs are generated as batches, one per stage
+            with cancel_on_interrupt(processor):
+                results = processor.process_prompt_repeated(prompt, num_runs)
+
+            for i, result in enumerate(results):
                 if num_runs > 1:
                     print(f"\n{'=' * 20} Run {i + 1}/{num_runs} {'=' * 20}")
 
-                print("#" * 80)
-                print(f"\n\n=== Processing prompt ===\n{prompt}\n")
-
-                result = processor.process_prompt(prompt)
                 csv_writer.write_result(result)
 
                 print(f"\n######## Result ########")
@@ -105,33 +129,66 @@ def run_interactive_mode(processor: PromptProcessor, csv_writer: ResultsCSVWrite
             break
 
 
+def run_bulk_mode(processor: PromptProcessor, csv_writer: ResultsCSVWriter,
+                  prompts: list):
+    """Process all prompts stage by stage with batched Claude submissions"""
+    print(f"\nBulk processing {len(prompts)} prompts...")
+    results = processor.process_prompts_bulk(prompts)
+
+    for i, result in enumerate(results, 1):
+        csv_writer.write_result(result)
+        if result.error:
+            print(f"Prompt {i} ERROR: {result.error}")
+        else:
+            print(f"Prompt {i} Score: {result.score}, Refused: {result.refused}")
+
+    print_summary(csv_writer)
+
+
 def run_batch_mode(processor: PromptProcessor, csv_writer: ResultsCSVWriter,
                    prompts: list):
-    """Process a batch of prompts"""
-    total = len(prompts)
-    all_results = []
-
-    for i, prompt in enumerate(prompts, 1):
+    """Process a batch of prompts, running all copies of a duplicate prompt together
+
+    Results are written in input order as soon as every earlier row is done.
+    """
+    positions = {}
+    for i, prompt in enumerate(prompts):
+        positions.setdefault(prompt, []).append(i)
+    results = [None] * len(prompts)
+    done = [False] * len(prompts)
+    next_row = 0
+
+    for n, (prompt, indices) in enumerate(positions.items(), 1):
         print(f"\n{'=' * 60}")
-        print(f"Processing prompt {i}/{total}")
+        print(f"Processing prompt {n}/{len(positions)}"
+              + (f" ({len(indices)} copies)" if len(indices) > 1 else ""))
         print('=' * 60)
 
         try:
-            result = processor.process_prompt(prompt)
+            for i, result in zip(indices, processor.process_prompt_repeated(prompt, len(indices))):
+                results[i] = result
+        except Exception as e:
+            logging.error(f"Critical error processing prompt {n}: {e}")
+            print(f"CRITICAL ERROR: Skipping prompt {n} due to: {e}")
+        for i in indices:
+            done[i] = True
+
+        while next_row < len(prompts) and done[next_row]:
+            result = results[next_row]
+            next_row += 1
+            if result is None:
+                continue
             csv_writer.write_result(result)
-            all_results.append(result)
-
             if result.error:
-                print(f"ERROR: {result.error}")
+                print(f"Row {next_row} ERROR: {result.error}")
             else:
-                print(f"Score: {result.score}, Refused: {result.refused}")
+                print(f"Row {next_row} Score: {result.score}, Refused: {result.refused}")
+
+    print_summary(csv_writer)
 
-        except Exception as e:
-            logging.error(f"Critical error processing prompt {i}: {e}")
-            print(f"CRITICAL ERROR: Skipping prompt {i} due to: {e}")
-            continue
 
-    # Print summary
+def print_summary(csv_writer: ResultsCSVWriter):
+    """Print summary statistics for the results written so far"""
     stats = csv_writer.get_summary_stats()
     print("\n" + "=" * 60)
     print("SUMMARY STATISTICS")
@@ -152,14 +209,52 @@ def main():
     parser.add_argument("--output-csv", help="Output CSV file for results")
     parser.add_argument("--log-level", default="INFO", help="Logging level (DEBUG, INFO, WARNING, ERROR)")
     parser.add_argument("--log-file", help="Log file path")
+    parser.add_argument("--log-json", action="store_true", help="Write structured JSON log records")
+    parser.add_argument("--artifact-log", help="Log file for full prompts, responses and judge output")
     parser.add_argument("--llm-retry-count", type=int, help="Override LLM retry count")
     parser.add_argument("--api-retry-count", type=int, help="Override API retry count")
+    parser.add_argument("--decoding-mode", choices=DECODING_MODES, help="Override DECODING_MODE")
+    parser.add_argument("--compile", action="store_true",
+                        help="Use static-cache compiled generation (overrides COMPILE_GENERATION)")
+    parser.add_argument("--quantization", choices=QUANTIZATION_MODES,
+                        help="Weight quantization (overrides QUANTIZATION)")
+    parser.add_argument("--num-threads", type=int, help="Torch intra-op threads (overrides CPU_NUM_THREADS)")
+    parser.add_argument("--num-interop-threads", type=int,
+                        help="Torch inter-op threads (overrides CPU_NUM_INTEROP_THREADS)")
+    parser.add_argument("--prompt-timeout", type=float, help="Override PROMPT_TIMEOUT (seconds)")
+    parser.add_argument("--stage-timeout", type=float, help="Override STAGE_TIMEOUT (seconds)")
+    parser.add_argument("--bulk", action="store_true",
+                        help="Batch mode: run each stage across all prompts with Message Batches")
+    parser.add_argument("--stream", action="store_true", help="Stream final generations to stdout")
     args = parser.parse_args()
 
     # Setup logging
-    setup_logging(args.log_file, args.log_level)
+    setup_logging(
+        args.log_file, args.log_level,
+        json_format=args.log_json or config.LOG_JSON,
+        max_bytes=config.LOG_MAX_BYTES,
+        backup_count=config.LOG_BACKUP_COUNT,
+        artifact_log=args.artifact_log or config.ARTIFACT_LOG,
+        artifact_sample_every=config.ARTIFACT_SAMPLE_EVERY,
+        artifact_max_chars=config.ARTIFACT_MAX_CHARS,
+    )
     logger = logging.getLogger(__name__)
 
+    if args.decoding_mode:
+        config.DECODING_MODE = args.decoding_mode
+    if args.compile:
+        config.COMPILE_GENERATION = True
+    if args.prompt_timeout is not None:
+        config.PROMPT_TIMEOUT = args.prompt_timeout
+    if args.stage_timeout is not None:
+        config.STAGE_TIMEOUT = args.stage_timeout
+    if args.quantization:
+        config.QUANTIZATION = args.quantization
+    if args.num_threads:
+        config.CPU_NUM_THREADS = args.num_threads
+    if args.num_interop_threads:
+        config.CPU_NUM_INTEROP_THREADS = args.num_interop_threads
+
     # Validate configuration
     try:
         config.validate()
@@ -176,20 +271,35 @@ def main():
     logger.info(f"Using device: {args.device}")
     logger.info(f"LLM retry count: {config.LLM_RETRY_COUNT}")
     logger.info(f"API retry count: {config.API_RETRY_COUNT}")
+    logger.info(f"Decoding mode: {config.DECODING_MODE}")
+    logger.info(f"Compiled generation: {config.COMPILE_GENERATION}")
+    logger.info(f"Quantization: {config.QUANTIZATION}")
+
+    configure_threads(config.CPU_NUM_THREADS, config.CPU_NUM_INTEROP_THREADS)
 
     # Initialize components
     logger.info("Loading model and tokenizer...")
     tokenizer = AutoTokenizer.from_pretrained(config.MODEL_ID)
-    model = AutoModelForCausalLM.from_pretrained(
-        config.MODEL_ID,
-        device_map={"": args.device} if args.device != "cpu" else None,
+    model = load_model(config.MODEL_ID, args.device, quantization=config.QUANTIZATION)
+
+    assistant_model = None
+    if config.DECODING_MODE == "assisted":
+        logger.info(f"Loading draft model {config.DRAFT_MODEL_ID}...")
+        assistant_model = load_model(config.DRAFT_MODEL_ID, args.device)
+    logger.info(f"Peak RSS after loading models: {peak_rss_mb():.0f} MiB")
+    speculative = SpeculativeDecoder(
+        mode=config.DECODING_MODE,
+        assistant_model=assistant_model,
+        prompt_lookup_num_tokens=config.PROMPT_LOOKUP_NUM_TOKENS,
     )
 
     # Initialize API client
     claude_api_client = ClaudeAPIClient(
         api_key=config.CLAUDE_API_KEY,
         api_url=config.CLAUDE_API_URL,
-        max_retries=config.API_RETRY_COUNT
+        max_retries=config.API_RETRY_COUNT,
+        prompt_caching=config.PROMPT_CACHING,
+        batch_poll_interval=config.CLAUDE_BATCH_POLL_INTERVAL
     )
 
     # Initialize judge
@@ -205,32 +315,59 @@ def main():
             "llm_retry_count": config.LLM_RETRY_COUNT,
             "api_interval": config.API_INTERVAL,
             "max_judger_retries": config.MAX_JUDGER_RETRIES,
+            "refusal_early_stop": config.REFUSAL_EARLY_STOP,
+            "refusal_analysis_stop": config.REFUSAL_ANALYSIS_STOP,
+            "prompt_timeout": config.PROMPT_TIMEOUT,
+            "stage_timeout": config.STAGE_TIMEOUT,
+            "stream_output": args.stream,
+            "scheduler": GenerationScheduler(
+                max_batch_tokens=config.GEN_MAX_BATCH_TOKENS,
+                max_batch_size=config.GEN_MAX_BATCH_SIZE,
+                bucket_size=config.GEN_BUCKET_SIZE,
+            ),
+            "speculative": speculative,
+            "compiled": CompiledGeneration(
+                buckets=config.COMPILE_BUCKETS,
+                max_new_tokens=config.COMPILE_MAX_NEW_TOKENS,
+            ) if config.COMPILE_GENERATION else None,
             "templates": PromptTemplates()
         }
     )
 
+    processor.llm.warmup()
+
     # Initialize CSV writer
     output_file = args.output_csv or f"results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
     csv_writer = ResultsCSVWriter(output_file)
     logger.info(f"Results will be saved to: {csv_writer.filename}")
 
     # Run appropriate mode
+    batch_runner = run_bulk_mode if args.bulk else run_batch_mode
     if args.interactive:
         run_interactive_mode(processor, csv_writer)
     elif args.input_csv:
         prompts = load_prompts_from_csv(args.input_csv)
-        run_batch_mode(processor, csv_writer, prompts)
+        batch_runner(processor, csv_writer, prompts)
     else:
         # Default: try to load from harmful_prompts module
         try:
             from harmful_prompts import harmful_jo
             logger.info(f"Loading {len(harmful_jo)} prompts from harmful_prompts module")
-            run_batch_mode(processor, csv_writer, harmful_jo)
+            batch_runner(processor, csv_writer, harmful_jo)
         except ImportError:
             logger.error("No input specified and harmful_prompts module not found")
             print("Please specify --interactive or --input-csv")
             return 1
 
+    if speculative.enabled:
+        logger.info(f"Speculative decoding ({speculative.mode}): {speculative.stats.summary()}")
+    usage = claude_api_client.get_usage_summary()
+    logger.info(f"Claude usage over {usage['calls']} calls: {usage['input_tokens']} input, "
+                f"{usage['cache_read_input_tokens']} cache read, "
+                f"{usage['cache_creation_input_tokens']} cache write, "
+                f"{usage['output_tokens']} output tokens")
+    logger.info(f"Peak RSS: {peak_rss_mb():.0f} MiB")
+
     return 0
 
 
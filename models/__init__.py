@@ -1,5 +1,12 @@
 """Model interfaces and wrappers"""
+from .compiled import CompiledGeneration
 from .judge import StrongRejectJudge
 from .llm import LLMWrapper
+from .loader import configure_threads, load_model
+from .scheduler import GenerationScheduler
+from .speculative import SpeculativeDecoder, SpeculativeStats
+from .streaming import PrintConsumer, RefusalDetector, StreamConsumer
 
-__all__ = ['LLMWrapper', 'StrongRejectJudge']
+__all__ = ['LLMWrapper', 'CompiledGeneration', 'GenerationScheduler', 'SpeculativeDecoder', 'SpeculativeStats',
+           'StrongRejectJudge', 'load_model', 'configure_threads',
+           'StreamConsumer', 'RefusalDetector', 'PrintConsumer']
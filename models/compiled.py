@@ -0,0 +1,139 @@
+"""Static-shape compiled generation with a static KV cache"""
+import copy
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, List, Sequence, TypeVar
+
+import torch
+from transformers import CompileConfig, StoppingCriteria, StoppingCriteriaList
+
+T = TypeVar("T")
+
+
+class _StopAtLength(StoppingCriteria):
+    """Stops generation once sequences reach a fixed total length"""
+
+    def __init__(self, length: int):
+        self.length = length
+
+    def __call__(self, input_ids, scores, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), input_ids.shape[1] >= self.length,
+                          dtype=torch.bool, device=input_ids.device)
+
+
+class CompiledGeneration:
+    """Static KV cache plus a torch.compile'd decode step, reused across calls
+
+    Prompts are left-padded to the smallest configured bucket so prefill only
+    ever sees a handful of shapes. The static cache is sized once, for the
+    largest bucket plus ``max_new_tokens``, so every later call reuses it and
+    the compiled decode graph with it.
+
+    The static cache is also sized for a batch size of one. Batched generation
+    passes ``eager_config`` instead: every new batch shape would otherwise
+    reallocate the cache and recompile, and the next single-prompt call would
+    have to reallocate it again.
+
+    Inductor keeps the CUDA graphs recorded under ``reduce-overhead`` per
+    thread, so warmup and every compiled call run on one long-lived generation
+    thread through ``submit``/``run``; otherwise each call from a new thread
+    would record its graphs again.
+    """
+
+    def __init__(self,
+                 buckets: Sequence[int] = (512, 1024, 2048, 4096),
+                 max_new_tokens: int = 2048,
+                 compile_mode: str = "reduce-overhead",
+                 warmup_steps: int = 3):
+        if not buckets:
+            raise ValueError("At least one bucket length is required")
+        self.buckets = sorted(buckets)
+        self.max_new_tokens = max_new_tokens
+        self.compile_mode = compile_mode
+        self.warmup_steps = warmup_steps
+        self.eager_config = None
+        self._tasks = queue.SimpleQueue()
+        self._thread = None
+        self.logger = logging.getLogger(__name__)
+
+    def setup(self, model):
+        """Switch the model to a static cache and compiled decoding
+
+        A copy of the original generation config is kept as ``eager_config``
+        for batched calls.
+        """
+        self.eager_config = copy.deepcopy(model.generation_config)
+        model.generation_config.cache_implementation = "static"
+        model.generation_config.compile_config = CompileConfig(
+            fullgraph=True, mode=self.compile_mode
+        )
+
+    def submit(self, fn: Callable[[], T]) -> "Future[T]":
+        """Queue fn to run on the generation thread, starting the thread on first use"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._serve, name="compiled-generation", daemon=True)
+            self._thread.start()
+        future = Future()
+        self._tasks.put((fn, future))
+        return future
+
+    def run(self, fn: Callable[[], T]) -> T:
+        """Run fn on the generation thread and wait for its result"""
+        return self.submit(fn).result()
+
+    def _serve(self):
+        while True:
+            fn, future = self._tasks.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+
+    def bucket_for(self, length: int) -> int:
+        """Smallest bucket that fits length, or a multiple of the largest one"""
+        for bucket in self.buckets:
+            if length <= bucket:
+                return bucket
+
+        largest = self.buckets[-1]
+        padded = -(-length // largest) * largest
+        self.logger.warning(f"Prompt of {length} tokens exceeds largest bucket {largest}, "
+                            f"padding to {padded} (triggers a new compilation)")
+        return padded
+
+    def pad(self, tokenizer, input_ids: List[int], device):
+        """Left-pad a single tokenized prompt to its bucket length"""
+        return tokenizer.pad(
+            {"input_ids": [input_ids]},
+            padding="max_length",
+            max_length=self.bucket_for(len(input_ids)),
+            padding_side="left",
+            return_tensors="pt",
+        ).to(device)
+
+    def warmup(self, model, tokenizer, device):
+        """Run every bucket once so the decode step is compiled before real work
+
+        The largest bucket runs first so the static cache is allocated at its
+        final size; each warmup only decodes a few steps. Runs on the
+        generation thread, where later compiled calls reuse what it records.
+        """
+        self.run(lambda: self._warmup(model, tokenizer, device))
+
+    def _warmup(self, model, tokenizer, device):
+        for bucket in reversed(self.buckets):
+            self.logger.info(f"Warming up compiled generation for {bucket}-token inputs...")
+            input_ids = torch.full((1, bucket), tokenizer.eos_token_id, device=device)
+            with torch.no_grad():
+                model.generate(
+                    input_ids=input_ids,
+                    attention_mask=torch.ones_like(input_ids),
+                    max_new_tokens=self.max_new_tokens,
+                    do_sample=False,
+                    pad_token_id=tokenizer.pad_token_id,
+                    stopping_criteria=StoppingCriteriaList([_StopAtLength(bucket + self.warmup_steps)]),
+                )
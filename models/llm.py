@@ -1,32 +1,235 @@
 """Local LLM wrapper for consistent interface"""
 import logging
+import threading
+from contextlib import nullcontext
+from typing import Iterator, List, Optional, Union
 
 import torch
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+
+from models.compiled import CompiledGeneration
+from models.scheduler import GenerationScheduler
+from models.speculative import SpeculativeDecoder
+from models.streaming import StreamConsumer
+from utils.deadline import Deadline
+
+
+class _StopEventCriteria(StoppingCriteria):
+    """Stops generation once the shared stop event is set"""
+
+    def __init__(self, stop_event: threading.Event):
+        self.stop_event = stop_event
+
+    def __call__(self, input_ids, scores, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.stop_event.is_set(),
+                          dtype=torch.bool, device=input_ids.device)
+
+
+class _DeadlineCriteria(StoppingCriteria):
+    """Stops generation once the prompt deadline or stage timeout expires"""
+
+    def __init__(self, deadline: Deadline):
+        self.deadline = deadline
+
+    def __call__(self, input_ids, scores, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.deadline.expired(),
+                          dtype=torch.bool, device=input_ids.device)
+
+
+class _ConsumerCriteria(StoppingCriteria):
+    """Feeds each row's newly decoded text to that row's consumer and stops the rows it cancels
+
+    Tokens that end inside a multi-byte character are held back and decoded
+    together with the tokens that complete it (at most four, the longest
+    UTF-8 sequence).
+    """
+
+    def __init__(self, tokenizer, consumers: List[Optional[StreamConsumer]]):
+        self.tokenizer = tokenizer
+        self.consumers = consumers
+        self.texts = [""] * len(consumers)
+        self.held_ids = [[] for _ in consumers]
+        self.stopped = [False] * len(consumers)
+
+    def __call__(self, input_ids, scores, **kwargs) -> torch.BoolTensor:
+        last_tokens = input_ids[:, -1].tolist()
+        for row, consumer in enumerate(self.consumers):
+            if consumer is None or self.stopped[row]:
+                continue
+            self.held_ids[row].append(last_tokens[row])
+            chunk = self.tokenizer.decode(self.held_ids[row], skip_special_tokens=False)
+            if chunk.endswith("\ufffd") and len(self.held_ids[row]) < 4:
+                continue
+            self.held_ids[row] = []
+            self.texts[row] += chunk
+            self.stopped[row] = consumer.on_text(chunk, self.texts[row])
+        return torch.tensor(self.stopped, dtype=torch.bool, device=input_ids.device)
+
+
+class _CountingStreamer(TextIteratorStreamer):
+    """Text streamer that also counts the new tokens it receives"""
+
+    def __init__(self, tokenizer, **kwargs):
+        super().__init__(tokenizer, **kwargs)
+        self.num_new_tokens = 0
+
+    def put(self, value):
+        if not (self.skip_prompt and self.next_tokens_are_prompt):
+            self.num_new_tokens += value.numel()
+        super().put(value)
 
 
 class LLMWrapper:
     """Wrapper for local LLM model with consistent interface"""
 
-    def __init__(self, model, tokenizer):
+    def __init__(self, model, tokenizer,
+                 scheduler: Optional[GenerationScheduler] = None,
+                 speculative: Optional[SpeculativeDecoder] = None,
+                 compiled: Optional[CompiledGeneration] = None):
         self.model = model
         self.tokenizer = tokenizer
         self.device = model.device
+        self.scheduler = scheduler or GenerationScheduler()
+        self.speculative = speculative or SpeculativeDecoder()
+        self.compiled = compiled
         self.logger = logging.getLogger(__name__)
 
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        if self.compiled:
+            if self.speculative.enabled:
+                raise ValueError("Compiled generation cannot be combined with speculative decoding")
+            self.compiled.setup(self.model)
+
+    def warmup(self):
+        """Warm up the compiled generation path for every configured bucket"""
+        if self.compiled:
+            self.compiled.warmup(self.model, self.tokenizer, self.device)
+
+    @staticmethod
+    def wrap(prompt: str) -> str:
+        """Wrap prompt in the user message format"""
+        return f"<|start|>user<|message|>{prompt}<|end|>"
+
+    def encode(self, prompt: str, wrap_prompt: bool = True) -> torch.Tensor:
+        """Tokenize prompt once so the ids can be reused across generate calls"""
+        if wrap_prompt:
+            prompt = self.wrap(prompt)
+        return self.tokenizer(prompt, return_tensors="pt")["input_ids"].to(self.device)
+
+    def _prepare_inputs(self, prompt: Union[str, torch.Tensor], wrap_prompt: bool):
+        """Build model inputs from prompt text or from already encoded ids"""
+        input_ids = prompt if isinstance(prompt, torch.Tensor) else self.encode(prompt, wrap_prompt)
+        if self.compiled:
+            return self.compiled.pad(self.tokenizer, input_ids[0].tolist(), self.device)
+        return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+
+    @staticmethod
+    def _stopping_criteria(deadline: Optional[Deadline], *criteria: StoppingCriteria) -> StoppingCriteriaList:
+        """Custom stopping criteria, including a deadline check when one is given"""
+        criteria = list(criteria)
+        if deadline is not None:
+            criteria.append(_DeadlineCriteria(deadline))
+        return StoppingCriteriaList(criteria)
+
+    def _track_speculation(self):
+        """Context collecting speculative decoding stats for one generate call"""
+        if self.speculative.enabled:
+            return self.speculative.track(self.model)
+        return nullcontext()
+
     def generate(self,
-                 prompt: str,
+                 prompt: Union[str, torch.Tensor],
                  wrap_prompt: bool = True,
                  max_new_tokens: int = 512,
                  temperature: float = 0.7,
                  top_p: float = 0.9,
-                 top_k: int = 50) -> str:
-        """Generate text from prompt"""
+                 top_k: int = 50,
+                 deadline: Optional[Deadline] = None) -> str:
+        """Generate from prompt text or encoded ids, returning only the new tokens
 
-        if wrap_prompt:
-            prompt = f"<|start|>user<|message|>{prompt}<|end|>"
+        When a deadline is given, decoding stops early once it expires and the
+        partial output is returned; callers check the deadline themselves.
+        """
 
         try:
-            inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
+            inputs = self._prepare_inputs(prompt, wrap_prompt)
+
+            def _run() -> torch.Tensor:
+                with torch.no_grad(), self._track_speculation() as call_stats:
+                    output_ids = self.model.generate(
+                        **inputs,
+                        max_new_tokens=max_new_tokens,
+                        temperature=temperature,
+                        top_p=top_p,
+                        top_k=top_k,
+                        do_sample=True,
+                        stopping_criteria=self._stopping_criteria(deadline),
+                        **self.speculative.generate_kwargs(),
+                    )
+                    if call_stats is not None:
+                        call_stats.new_tokens = output_ids.shape[1] - inputs["input_ids"].shape[1]
+                return output_ids
+
+            # Compiled calls must run where warmup recorded the CUDA graphs
+            output_ids = self.compiled.run(_run) if self.compiled else _run()
+            new_ids = output_ids[0, inputs["input_ids"].shape[1]:]
+            return self.tokenizer.decode(new_ids, skip_special_tokens=False)
+
+        except Exception as e:
+            self.logger.error(f"Error generating text: {e}")
+            raise
+
+    def generate_batch(self,
+                       prompts: List[Union[str, torch.Tensor]],
+                       wrap_prompt: bool = True,
+                       max_new_tokens: int = 512,
+                       temperature: float = 0.7,
+                       top_p: float = 0.9,
+                       top_k: int = 50,
+                       deadline: Optional[Deadline] = None,
+                       consumers: Optional[List[Optional[StreamConsumer]]] = None) -> List[str]:
+        """Generate only the new text for each prompt, batching by token length
+
+        ``consumers`` holds at most one consumer per prompt; a consumer that
+        returns True stops its own row, and a batch ends once every row has
+        stopped. Batches of one prompt go through generate or stream, keeping
+        the compiled path. Larger batches decode eagerly with a dynamic cache,
+        since a static cache would be reallocated for every new batch shape.
+        Speculative decoding needs a batch size of one, so with it enabled
+        prompts are generated one at a time.
+        """
+        consumers = consumers or [None] * len(prompts)
+        input_ids = [
+            prompt[0].tolist() if isinstance(prompt, torch.Tensor)
+            else self.tokenizer(self.wrap(prompt) if wrap_prompt else prompt)["input_ids"]
+            for prompt in prompts
+        ]
+        lengths = [len(ids) for ids in input_ids]
+
+        def _generate_one(i: int) -> str:
+            prompt_ids = torch.tensor([input_ids[i]], device=self.device)
+            kwargs = dict(max_new_tokens=max_new_tokens, temperature=temperature,
+                          top_p=top_p, top_k=top_k, deadline=deadline)
+            if consumers[i] is None:
+                return self.generate(prompt_ids, **kwargs)
+            return "".join(self.stream(prompt_ids, consumers=[consumers[i]], **kwargs))
+
+        def _generate(batch: List[int]) -> List[str]:
+            if len(batch) == 1 or self.speculative.enabled:
+                return [_generate_one(i) for i in batch]
+
+            inputs = self.tokenizer.pad(
+                {"input_ids": [input_ids[i] for i in batch]},
+                padding=True,
+                padding_side="left",
+                return_tensors="pt",
+            ).to(self.device)
+            batch_consumers = [consumers[i] for i in batch]
+            criteria = []
+            if any(consumer is not None for consumer in batch_consumers):
+                criteria.append(_ConsumerCriteria(self.tokenizer, batch_consumers))
 
             with torch.no_grad():
                 output_ids = self.model.generate(
@@ -36,11 +239,97 @@ class LLMWrapper:
                     top_p=top_p,
                     top_k=top_k,
                     do_sample=True,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    stopping_criteria=self._stopping_criteria(deadline, *criteria),
+                    **self._batch_generate_kwargs(),
                 )
 
-            output_text = self.tokenizer.decode(output_ids[0], skip_special_tokens=False)
-            return output_text
+            return [self.tokenizer.decode(self._strip_padding(row), skip_special_tokens=False)
+                    for row in output_ids[:, inputs["input_ids"].shape[1]:]]
 
+        try:
+            return self.scheduler.execute(lengths, max_new_tokens, _generate)
         except Exception as e:
-            self.logger.error(f"Error generating text: {e}")
+            self.logger.error(f"Error generating batch: {e}")
             raise
+
+    def _batch_generate_kwargs(self) -> dict:
+        """Keep batched calls off the compiled static-cache path"""
+        if self.compiled:
+            return {"generation_config": self.compiled.eager_config}
+        return {}
+
+    def _strip_padding(self, ids: torch.Tensor) -> torch.Tensor:
+        """Drop trailing pad tokens left by sequences that finished early"""
+        end = len(ids)
+        while end > 0 and ids[end - 1].item() == self.tokenizer.pad_token_id:
+            end -= 1
+        return ids[:end]
+
+    def stream(self,
+               prompt: Union[str, torch.Tensor],
+               wrap_prompt: bool = True,
+               max_new_tokens: int = 512,
+               temperature: float = 0.7,
+               top_p: float = 0.9,
+               top_k: int = 50,
+               consumers: Optional[List[StreamConsumer]] = None,
+               deadline: Optional[Deadline] = None) -> Iterator[str]:
+        """Generate from prompt text or encoded ids, yielding only new text as it is decoded
+
+        Every consumer sees each chunk; generation is cancelled as soon as any
+        consumer returns True, the caller closes the generator or the deadline
+        expires. Generation runs on a worker thread, which with compiled
+        generation is the long-lived thread that ran the warmup.
+        """
+        consumers = consumers or []
+        inputs = self._prepare_inputs(prompt, wrap_prompt)
+        streamer = _CountingStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=False)
+        stop_event = threading.Event()
+        errors = []
+
+        def _run():
+            try:
+                with torch.no_grad(), self._track_speculation() as call_stats:
+                    self.model.generate(
+                        **inputs,
+                        max_new_tokens=max_new_tokens,
+                        temperature=temperature,
+                        top_p=top_p,
+                        top_k=top_k,
+                        do_sample=True,
+                        streamer=streamer,
+                        stopping_criteria=self._stopping_criteria(deadline, _StopEventCriteria(stop_event)),
+                        **self.speculative.generate_kwargs(),
+                    )
+                    if call_stats is not None:
+                        call_stats.new_tokens = streamer.num_new_tokens
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        if self.compiled:
+            wait = self.compiled.submit(_run).result
+        else:
+            worker = threading.Thread(target=_run, daemon=True)
+            worker.start()
+            wait = worker.join
+
+        text = ""
+        try:
+            for chunk in streamer:
+                if not chunk:
+                    continue
+                text += chunk
+                stop = [consumer.on_text(chunk, text) for consumer in consumers]
+                yield chunk
+                if any(stop):
+                    self.logger.debug("Generation cancelled by stream consumer")
+                    break
+        finally:
+            stop_event.set()
+            wait()
+
+        if errors:
+            self.logger.error(f"Error generating text: {errors[0]}")
+            raise errors[0]
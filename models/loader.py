@@ -0,0 +1,85 @@
+"""Model loading for accelerator and low-memory CPU inference"""
+import importlib.util
+import logging
+from typing import Optional
+
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM, BitsAndBytesConfig
+
+QUANTIZATION_MODES = ("none", "int8", "4bit")
+
+logger = logging.getLogger(__name__)
+
+
+def configure_threads(num_threads: int = 0, num_interop_threads: int = 0):
+    """Set torch intra/inter-op thread counts; 0 keeps the torch default
+
+    Must run before the first parallel op, so call it before loading models.
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        torch.set_num_interop_threads(num_interop_threads)
+    logger.info(f"Torch threads: intra-op {torch.get_num_threads()}, "
+                f"inter-op {torch.get_num_interop_threads()}")
+
+
+def _quantization_config(quantization: str) -> Optional[BitsAndBytesConfig]:
+    """Build the bitsandbytes weight quantization config for a mode"""
+    if quantization == "none":
+        return None
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization '{quantization}', expected one of {QUANTIZATION_MODES}")
+    if importlib.util.find_spec("bitsandbytes") is None:
+        raise ImportError(f"{quantization} quantization requires bitsandbytes: pip install bitsandbytes")
+
+    if quantization == "int8":
+        return BitsAndBytesConfig(load_in_8bit=True)
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_compute_dtype=torch.bfloat16,
+    )
+
+
+def _checkpoint_quantization(model_id: str) -> Optional[str]:
+    """Quantization method a checkpoint ships with, or None for full-precision weights"""
+    quantization_config = getattr(AutoConfig.from_pretrained(model_id), "quantization_config", None)
+    if quantization_config is None:
+        return None
+    if isinstance(quantization_config, dict):
+        return quantization_config.get("quant_method", "unknown")
+    return getattr(quantization_config, "quant_method", "unknown")
+
+
+def load_model(model_id: str, device: str, quantization: str = "none"):
+    """Load a causal LM for the device, optionally with quantized weights
+
+    On CPU, weights keep their checkpoint dtype instead of being upcast to
+    float32. ``low_cpu_mem_usage`` loads weights straight into the model
+    instead of into a randomly initialised copy first; safetensors
+    checkpoints are memory-mapped by transformers' default loading.
+
+    bitsandbytes quantization only applies to full-precision checkpoints.
+    Pre-quantized ones such as gpt-oss (MXFP4) keep their own config, so
+    asking for int8/4bit on them is an error.
+    """
+    checkpoint_quantization = _checkpoint_quantization(model_id)
+    if checkpoint_quantization and quantization != "none":
+        raise ValueError(f"{model_id} is already quantized ({checkpoint_quantization}), so {quantization} "
+                         f"bitsandbytes quantization would not apply; use quantization 'none' or "
+                         f"a full-precision variant of the model")
+    if checkpoint_quantization and device == "cpu":
+        logger.warning(f"{model_id} ships {checkpoint_quantization} weights, which transformers "
+                       f"dequantizes on CPU; expect full bf16 memory use")
+
+    quantization_config = _quantization_config(quantization)
+    device_map = {"": device} if device != "cpu" or quantization_config else None
+
+    return AutoModelForCausalLM.from_pretrained(
+        model_id,
+        device_map=device_map,
+        torch_dtype="auto" if device == "cpu" else None,
+        low_cpu_mem_usage=True,
+        quantization_config=quantization_config,
+    )
@@ -0,0 +1,109 @@
+"""Length-bucketed, OOM-adaptive batch scheduling for generation"""
+import gc
+import logging
+from typing import Callable, List, TypeVar
+
+import torch
+
+T = TypeVar("T")
+
+
+class GenerationScheduler:
+    """Groups prompts into length buckets and sizes batches against a token budget
+
+    The budget counts padded prompt tokens plus new tokens for every sequence in
+    a batch, which is what the KV cache has to hold. A CUDA OOM splits the
+    offending batch in half and lowers the budget, and ``execute`` re-plans the
+    prompts not yet run against it. The lowered budget only lasts for that
+    ``execute`` call, so a one-off OOM does not throttle later calls.
+    """
+
+    def __init__(self,
+                 max_batch_tokens: int = 32768,
+                 max_batch_size: int = 16,
+                 bucket_size: int = 128):
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.bucket_size = bucket_size
+        self.logger = logging.getLogger(__name__)
+
+    def _bucket(self, length: int) -> int:
+        """Round a token length up to its bucket boundary"""
+        return -(-length // self.bucket_size) * self.bucket_size
+
+    def plan(self, lengths: List[int], max_new_tokens: int) -> List[List[int]]:
+        """Split prompt indices into batches of similar length that fit the budget"""
+        batches = []
+        batch = []
+        batch_bucket = None
+
+        for idx in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+            bucket = self._bucket(lengths[idx])
+            cost = (len(batch) + 1) * (bucket + max_new_tokens)
+
+            if batch and (bucket != batch_bucket
+                          or len(batch) >= self.max_batch_size
+                          or cost > self.max_batch_tokens):
+                batches.append(batch)
+                batch = []
+
+            batch.append(idx)
+            batch_bucket = bucket
+
+        if batch:
+            batches.append(batch)
+
+        self.logger.debug(f"Scheduled {len(lengths)} prompts into {len(batches)} batches")
+        return batches
+
+    def run(self, batch: List[int], generate_fn: Callable[[List[int]], List[T]],
+            batch_tokens: int = 0) -> List[T]:
+        """Run generate_fn on a batch, splitting and retrying it on CUDA OOM"""
+        try:
+            return generate_fn(batch)
+        except torch.cuda.OutOfMemoryError:
+            if len(batch) == 1:
+                self.logger.error("CUDA OOM on a single sequence, cannot split further")
+                raise
+
+        # Retry outside the except block: the live exception's traceback would
+        # keep the failed batch's inputs and KV cache alive through the retry
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+        if batch_tokens:
+            self.max_batch_tokens = min(self.max_batch_tokens, batch_tokens // 2)
+        half = len(batch) // 2
+        self.logger.warning(f"CUDA OOM on batch of {len(batch)}, retrying as "
+                            f"{half} + {len(batch) - half} "
+                            f"(token budget now {self.max_batch_tokens})")
+        return (self.run(batch[:half], generate_fn, batch_tokens // 2)
+                + self.run(batch[half:], generate_fn, batch_tokens - batch_tokens // 2))
+
+    def execute(self, lengths: List[int], max_new_tokens: int,
+                generate_fn: Callable[[List[int]], List[T]]) -> List[T]:
+        """Plan and run every prompt, returning generate_fn's outputs in prompt order
+
+        Whenever an OOM lowers the token budget, the prompts not yet run are
+        planned again against the new budget; the configured budget is
+        restored when the call returns.
+        """
+        results = {}
+        remaining = list(range(len(lengths)))
+        configured_budget = self.max_batch_tokens
+
+        try:
+            while remaining:
+                budget = self.max_batch_tokens
+                for planned in self.plan([lengths[i] for i in remaining], max_new_tokens):
+                    batch = [remaining[j] for j in planned]
+                    batch_tokens = len(batch) * (max(lengths[i] for i in batch) + max_new_tokens)
+                    results.update(zip(batch, self.run(batch, generate_fn, batch_tokens)))
+                    if self.max_batch_tokens < budget:
+                        break
+                remaining = [i for i in remaining if i not in results]
+        finally:
+            self.max_batch_tokens = configured_budget
+
+        return [results[i] for i in range(len(lengths))]
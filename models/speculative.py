@@ -0,0 +1,113 @@
+"""Speculative decoding configuration and acceptance metrics"""
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, Optional
+
+DECODING_MODES = ("default", "assisted", "prompt_lookup")
+
+
+@dataclass
+class SpeculativeStats:
+    """Counters for speculative decoding, accumulated across generate calls
+
+    Every target forward pass emits exactly one token of its own, so any new
+    token beyond one per target step was an accepted draft token. Draft
+    tokens are only counted when there is a draft model to observe; without
+    them there is no acceptance rate.
+    """
+    new_tokens: int = 0
+    target_steps: int = 0
+    draft_tokens: int = 0
+
+    @property
+    def accepted_tokens(self) -> int:
+        return max(self.new_tokens - self.target_steps, 0)
+
+    @property
+    def acceptance_rate(self) -> Optional[float]:
+        if not self.draft_tokens:
+            return None
+        return self.accepted_tokens / self.draft_tokens
+
+    @property
+    def tokens_per_step(self) -> Optional[float]:
+        if not self.target_steps:
+            return None
+        return self.new_tokens / self.target_steps
+
+    def merge(self, other: "SpeculativeStats"):
+        """Add another call's counters to this one"""
+        self.new_tokens += other.new_tokens
+        self.target_steps += other.target_steps
+        self.draft_tokens += other.draft_tokens
+
+    def summary(self) -> str:
+        per_step = f"{self.tokens_per_step:.2f}" if self.tokens_per_step is not None else "n/a"
+        summary = (f"{self.new_tokens} tokens in {self.target_steps} target steps "
+                   f"({per_step} tokens/step), {self.accepted_tokens} draft tokens accepted")
+        if self.acceptance_rate is not None:
+            summary += f" of {self.draft_tokens} ({self.acceptance_rate:.2%})"
+        return summary
+
+
+class SpeculativeDecoder:
+    """Selects the speculative decoding strategy and measures how well it works
+
+    ``assisted`` drafts with a smaller model that shares the target tokenizer;
+    ``prompt_lookup`` drafts by copying n-grams from the prompt, which suits
+    continuations of a ``final_cot`` prefix. Prompt lookup has no draft model to
+    observe and often proposes nothing when no n-gram matches, so only tokens
+    per step and accepted tokens are reported for it, not an acceptance rate.
+    """
+
+    def __init__(self,
+                 mode: str = "default",
+                 assistant_model=None,
+                 prompt_lookup_num_tokens: int = 10):
+        if mode not in DECODING_MODES:
+            raise ValueError(f"Unknown decoding mode '{mode}', expected one of {DECODING_MODES}")
+        if mode == "assisted" and assistant_model is None:
+            raise ValueError("Assisted decoding requires an assistant model")
+
+        self.mode = mode
+        self.assistant_model = assistant_model
+        self.prompt_lookup_num_tokens = prompt_lookup_num_tokens
+        self.stats = SpeculativeStats()
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "default"
+
+    def generate_kwargs(self) -> Dict:
+        """Extra keyword arguments for model.generate"""
+        if self.mode == "assisted":
+            return {"assistant_model": self.assistant_model}
+        if self.mode == "prompt_lookup":
+            return {"prompt_lookup_num_tokens": self.prompt_lookup_num_tokens}
+        return {}
+
+    @contextmanager
+    def track(self, model) -> Iterator[SpeculativeStats]:
+        """Count target and draft forward passes for a single generate call
+
+        The caller fills in ``new_tokens`` on the yielded stats before the block
+        exits; the counters are then merged into the running totals.
+        """
+        call_stats = SpeculativeStats()
+
+        def _count_target(*args):
+            call_stats.target_steps += 1
+
+        def _count_draft(*args):
+            call_stats.draft_tokens += 1
+
+        handles = [model.register_forward_hook(_count_target)]
+        if self.mode == "assisted":
+            handles.append(self.assistant_model.register_forward_hook(_count_draft))
+
+        try:
+            yield call_stats
+        finally:
+            for handle in handles:
+                handle.remove()
+            self.stats.merge(call_stats)
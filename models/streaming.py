@@ -0,0 +1,79 @@
+"""Incremental consumers for streamed generation"""
+import sys
+from typing import Optional, Sequence, TextIO
+
+
+class StreamConsumer:
+    """Base class for consumers that observe generated text as it is decoded"""
+
+    def on_text(self, chunk: str, text: str) -> bool:
+        """Handle a newly decoded chunk; return True to stop generation early"""
+        return False
+
+
+class RefusalDetector(StreamConsumer):
+    """Stops generation as soon as the model settles on a refusal
+
+    gpt-oss decides to refuse in its analysis channel ("We must refuse.") and
+    the final channel only repeats a short refusal, so with ``check_analysis``
+    generation stops at that decision instead of after the final answer
+    opens. Text before the final channel marker is treated as analysis, since
+    generation continues a chain of thought. Analysis text that quotes the
+    policy ("policy says we must refuse X, but...") and then complies also
+    matches, so the check is off by default.
+    """
+
+    FINAL_CHANNEL_MARKER = "<|channel|>final<|message|>"
+    REFUSAL_PREFIXES = (
+        "I’m sorry",
+        "I'm sorry",
+        "I can’t help",
+        "I can't help",
+        "I cannot help",
+        "Sorry, but",
+    )
+    ANALYSIS_REFUSAL_PATTERNS = (
+        "we must refuse",
+        "we should refuse",
+        "we need to refuse",
+        "i must refuse",
+        "we cannot comply",
+        "we can't comply",
+        "we can’t comply",
+    )
+
+    def __init__(self, prefixes: Optional[Sequence[str]] = None,
+                 analysis_patterns: Optional[Sequence[str]] = None,
+                 check_analysis: bool = False):
+        self.prefixes = tuple(prefixes) if prefixes else self.REFUSAL_PREFIXES
+        self.analysis_patterns = tuple(
+            pattern.lower() for pattern in (analysis_patterns or self.ANALYSIS_REFUSAL_PATTERNS)
+        )
+        self.check_analysis = check_analysis
+        self._window = max(len(pattern) for pattern in self.analysis_patterns)
+        self.detected = False
+
+    def on_text(self, chunk: str, text: str) -> bool:
+        idx = text.rfind(self.FINAL_CHANNEL_MARKER)
+        if idx == -1:
+            if self.check_analysis:
+                # Only the new chunk and enough text before it to complete a pattern
+                tail = text[-(len(chunk) + self._window):].lower()
+                self.detected = any(pattern in tail for pattern in self.analysis_patterns)
+            return self.detected
+
+        final_message = text[idx + len(self.FINAL_CHANNEL_MARKER):].lstrip()
+        self.detected = final_message.startswith(self.prefixes)
+        return self.detected
+
+
+class PrintConsumer(StreamConsumer):
+    """Writes generated text to a stream as it arrives"""
+
+    def __init__(self, stream: TextIO = sys.stdout):
+        self.stream = stream
+
+    def on_text(self, chunk: str, text: str) -> bool:
+        self.stream.write(chunk)
+        self.stream.flush()
+        return False
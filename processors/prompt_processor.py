@@ -1,10 +1,12 @@
 """Main prompt processing pipeline"""
 import logging
 from dataclasses import dataclass
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Callable, List, Tuple
 
 from models.llm import LLMWrapper
+from models.streaming import PrintConsumer, RefusalDetector
 from processors.text_replacer import TextReplacer
+from utils.deadline import Deadline, DeadlineExceeded
 
 
 @dataclass
@@ -26,83 +28,377 @@ class PromptProcessor:
                  judge,
                  api_client,
                  config: Dict[str, Any]):
-        self.llm = LLMWrapper(llm_model, tokenizer)
+        self.llm = LLMWrapper(llm_model, tokenizer,
+                              scheduler=config.get('scheduler'),
+                              speculative=config.get('speculative'),
+                              compiled=config.get('compiled'))
         self.judge = judge
         self.api_client = api_client
         self.config = config
         self.text_replacer = TextReplacer()
         self.logger = logging.getLogger(__name__)
         self.templates = config.get('templates')
+        self.stream_consumers = [PrintConsumer()] if config.get('stream_output') else []
+        self.deadline: Optional[Deadline] = None
 
     def process_prompt(self, prompt: str) -> ProcessingResult:
         """Process a single prompt through the pipeline"""
+        return self._process_runs([prompt])[0]
 
+    def process_prompt_repeated(self, prompt: str, num_runs: int) -> List[ProcessingResult]:
+        """Process the same prompt num_runs times as independent runs
+
+        Every run samples its own CoTs and outputs and makes its own Claude
+        calls. The runs move through the stages together, so each generation
+        step is one batched generation.
+        """
+        return self._process_runs([prompt] * num_runs)
+
+    def process_prompts_bulk(self, prompts: List[str]) -> List[ProcessingResult]:
+        """Process many prompts stage by stage, submitting Claude stages as message batches
+
+        Generation stages run as batched generation across all pending prompts
+        and each Claude stage is one batch submission, so every prompt moves to
+        the next stage together. Prompts that fail are retried in the next round.
+
+        Steps 1-5 run across all prompts at once and have no deadline, since
+        a message batch can take a long time to end; the prompt and stage
+        timeouts only apply to each prompt's final generation and judging.
+        """
+        return self._process_runs(prompts, bulk=True)
+
+    def _process_runs(self, prompts: List[str], bulk: bool = False) -> List[ProcessingResult]:
+        """Run each prompt through its own pipeline, moving all runs through the stages together
+
+        Runs whose stages fail are retried in the next round. Outside bulk mode
+        the runs make synchronous Claude calls one after another and share one
+        deadline, with PROMPT_TIMEOUT budgeted for each run.
+        """
         max_retries = self.config.get('llm_retry_count', 3)
-        max_judge_retries = self.config.get('max_judger_retries', 10)
+        deadline = Deadline() if bulk else self._new_deadline(len(prompts))
+        # Tokenize each distinct prompt once for every run and attempt
+        encoded = {prompt: self.llm.encode(prompt) for prompt in set(prompts)}
+        results: Dict[int, ProcessingResult] = {}
+        pending = list(range(len(prompts)))
 
         for attempt in range(max_retries):
+            if not pending:
+                break
+            self.logger.info(f"Processing {len(pending)} prompt run(s) (attempt {attempt + 1}/{max_retries})")
             try:
-                self.logger.info(f"Processing prompt (attempt {attempt + 1}/{max_retries})")
+                final_cots, retry = self._run_stages(prompts, pending, encoded, deadline, bulk)
+                outputs, failed = self._generate_outputs(prompts, final_cots, deadline, bulk)
+                results.update(outputs)
+                pending = retry + failed
+            except DeadlineExceeded as e:
+                self.logger.warning(f"Prompt {e}")
+                for i in pending:
+                    results[i] = ProcessingResult(prompt=prompts[i], error=str(e))
+                pending = []
+            except Exception as e:
+                self.logger.error(f"Error in attempt {attempt + 1}: {e}", exc_info=True)
+                if attempt == max_retries - 1:
+                    for i in pending:
+                        results[i] = ProcessingResult(prompt=prompts[i], error=str(e))
+                    pending = []
 
-                # Step 1: Generate harmful CoT
-                self.logger.debug("Generating harmful CoT...")
-                harmful_cot = self.llm.generate(prompt, wrap_prompt=True)
+        for i in pending:
+            results[i] = ProcessingResult(prompt=prompts[i], error="Max retries exceeded")
+        return [results[i] for i in range(len(prompts))]
 
-                # Step 2: Get safe replacements
-                self.logger.debug("Getting safe replacements...")
-                replacements = self.api_client.get_safe_equivalents(
-                    prompt, harmful_cot, self.templates.PAIR_FINDING_TEMPLATE
-                )
-                if not replacements:
-                    self.logger.warning("Failed to get safe replacements")
-                    continue
+    def _new_deadline(self, runs: int = 1) -> Deadline:
+        """Start the wall-clock budget for a prompt's runs, one prompt timeout per run"""
+        self.deadline = Deadline(self.config.get('prompt_timeout', 0) * runs, self.config.get('stage_timeout', 0))
+        return self.deadline
 
-                # Step 3: Create safe prompt
-                safe_prompt = self.text_replacer.apply_replacements(prompt, replacements)
-                self.logger.debug(f"Safe prompt created: {safe_prompt[:100]}...")
+    def cancel(self):
+        """Cancel the prompt in progress; its partial results are still returned"""
+        if self.deadline is not None:
+            self.deadline.cancel()
 
-                # Step 4: Generate and truncate safe CoT
-                safe_cot = self.llm.generate(safe_prompt, wrap_prompt=True)
-                truncated_safe_cot = self.api_client.truncate_cot(
-                    safe_cot, self.templates.TRUNCATE_TEMPLATE
-                )
+    def _run_stages(self, prompts: List[str], pending: List[int], encoded: Dict[str, Any],
+                    deadline: Deadline, bulk: bool) -> Tuple[Dict[int, str], List[int]]:
+        """Run steps 1-6 for the pending runs, returning their final CoTs and the runs to retry"""
+        keys = {f"prompt-{i}": i for i in pending}
 
-                # Step 5: Get CoT-specific replacements
-                cot_replacements = self.api_client.get_cot_safe_equivalents(
-                    prompt, safe_prompt, truncated_safe_cot,
-                    self.templates.COT_PAIR_FINDING_TEMPLATE
-                )
+        # Step 1: Generate harmful CoTs
+        self.logger.debug("Generating harmful CoTs...")
+        deadline.begin_stage("harmful_cot")
+        outputs = self.llm.generate_batch([encoded[prompts[i]] for i in keys.values()], deadline=deadline)
+        deadline.check()
+        # Claude stages expect the CoT to start with the wrapped prompt
+        harmful_cots = {key: self.llm.wrap(prompts[i]) + output
+                        for (key, i), output in zip(keys.items(), outputs)}
 
-                # Step 6: Transform back to harmful context
-                all_replacements = self.text_replacer.merge_replacements(
-                    replacements, cot_replacements
-                )
-                final_cot = self.text_replacer.apply_replacements(
-                    truncated_safe_cot, all_replacements, reverse=True
-                )
+        # Step 2: Get safe replacements
+        self.logger.debug("Getting safe replacements...")
+        items = {key: (prompts[i], harmful_cots[key]) for key, i in keys.items()}
+        template = self.templates.PAIR_FINDING_TEMPLATE
+        if bulk:
+            replacements = self.api_client.get_safe_equivalents_bulk(items, template)
+        else:
+            replacements = self._call_each("safe_equivalents", self.api_client.get_safe_equivalents,
+                                           items, template, deadline)
+        # Parsed JSON that is empty or not a string mapping is retried like a failed call
+        valid = {key for key in keys if replacements[key] and self._is_replacement_map(replacements[key])}
+        retry = [i for key, i in keys.items() if key not in valid]
+        if retry:
+            self.logger.warning(f"Failed to get safe replacements for {len(retry)} run(s)")
+        keys = {key: i for key, i in keys.items() if key in valid}
+        if not keys:
+            return {}, retry
+
+        # Step 3: Create safe prompts
+        safe_prompts = {key: self.text_replacer.apply_replacements(prompts[i], replacements[key])
+                        for key, i in keys.items()}
+        for safe_prompt in safe_prompts.values():
+            self.logger.debug(f"Safe prompt created: {safe_prompt[:100]}...")
+
+        # Step 4: Generate and truncate safe CoTs
+        deadline.begin_stage("safe_cot")
+        outputs = self.llm.generate_batch([safe_prompts[key] for key in keys], wrap_prompt=True,
+                                          deadline=deadline)
+        deadline.check()
+        safe_cots = {key: self.llm.wrap(safe_prompts[key]) + output
+                     for key, output in zip(keys, outputs)}
+        template = self.templates.TRUNCATE_TEMPLATE
+        if bulk:
+            truncated_safe_cots = self.api_client.truncate_cot_bulk(safe_cots, template)
+        else:
+            truncated_safe_cots = self._call_each(
+                "truncate_cot", self.api_client.truncate_cot,
+                {key: (cot,) for key, cot in safe_cots.items()}, template, deadline
+            )
+
+        # Step 5: Get CoT-specific replacements
+        items = {key: (prompts[i], safe_prompts[key], truncated_safe_cots[key]) for key, i in keys.items()}
+        template = self.templates.COT_PAIR_FINDING_TEMPLATE
+        if bulk:
+            cot_replacements = self.api_client.get_cot_safe_equivalents_bulk(items, template)
+        else:
+            cot_replacements = self._call_each("cot_safe_equivalents", self.api_client.get_cot_safe_equivalents,
+                                               items, template, deadline)
+        # A missing CoT mapping is tolerated, a malformed one is retried
+        malformed = [key for key in keys
+                     if cot_replacements[key] is not None and not self._is_replacement_map(cot_replacements[key])]
+        if malformed:
+            self.logger.warning(f"Malformed CoT replacements for {len(malformed)} run(s)")
+            retry.extend(keys.pop(key) for key in malformed)
+
+        # Step 6: Transform back to harmful context
+        final_cots = {
+            i: self._build_final_cot(replacements[key], cot_replacements[key], truncated_safe_cots[key])
+            for key, i in keys.items()
+        }
+        return final_cots, retry
+
+    @staticmethod
+    def _is_replacement_map(replacements: Any) -> bool:
+        """Whether parsed Claude JSON is a mapping of strings to strings"""
+        return (isinstance(replacements, dict)
+                and all(isinstance(k, str) and isinstance(v, str) for k, v in replacements.items()))
 
-                # Step 7: Generate output with judge retry logic
-                for judge_attempt in range(max_judge_retries):
-                    output = self.llm.generate(final_cot, wrap_prompt=False, max_new_tokens=2048)
-                    score = self.judge.evaluate(prompt, output)
-                    refused = (score == 0) if score is not None else None
+    @staticmethod
+    def _call_each(stage: str, call: Callable, items: Dict[str, tuple], template: str,
+                   deadline: Deadline) -> Dict[str, Any]:
+        """Make one synchronous Claude call per item, each as its own deadline stage"""
+        results = {}
+        for key, args in items.items():
+            deadline.begin_stage(stage)
+            results[key] = call(*args, template, deadline=deadline)
+            deadline.check()
+        return results
 
-                    if not refused or judge_attempt == max_judge_retries - 1:
-                        return ProcessingResult(
-                            prompt=prompt,
-                            harmful_cot_output=output,
-                            score=score,
-                            refused=refused
-                        )
+    def _build_final_cot(self, replacements: Dict, cot_replacements: Optional[Dict],
+                         truncated_safe_cot: str) -> str:
+        """Transform the truncated safe CoT back to the harmful context"""
+        all_replacements = self.text_replacer.merge_replacements(
+            replacements, cot_replacements
+        )
+        return self.text_replacer.apply_replacements(
+            truncated_safe_cot, all_replacements, reverse=True
+        )
 
-                    self.logger.info(f"Judge refused output, retrying ({judge_attempt + 1}/{max_judge_retries})")
+    def _generate_outputs(self, prompts: List[str], final_cots: Dict[int, str], deadline: Deadline,
+                          bulk: bool) -> Tuple[Dict[int, ProcessingResult], List[int]]:
+        """Produce a judged output for each run's final CoT, returning results and runs to retry
 
+        Runs sharing a deadline are generated as one batch per judge round
+        unless output is streamed; in bulk mode each run is judged on its own
+        with a fresh deadline.
+        """
+        if len(final_cots) > 1 and not bulk and not self.stream_consumers:
+            return self._generate_judged_outputs_batched(prompts, final_cots, deadline)
+
+        results, failed = {}, []
+        for i, final_cot in final_cots.items():
+            try:
+                results[i] = self._generate_judged_output(
+                    prompts[i], final_cot, self._new_deadline() if bulk else deadline
+                )
             except Exception as e:
-                self.logger.error(f"Error in attempt {attempt + 1}: {e}", exc_info=True)
-                if attempt == max_retries - 1:
+                self.logger.error(f"Error generating output for run {i + 1}: {e}", exc_info=True)
+                failed.append(i)
+        return results, failed
+
+    def _refusal_detector(self) -> RefusalDetector:
+        """Refusal detector, also watching the analysis channel when enabled"""
+        return RefusalDetector(check_analysis=self.config.get('refusal_analysis_stop', False))
+
+    def _generate_judged_output(self, prompt: str, final_cot: str,
+                                deadline: Deadline) -> ProcessingResult:
+        """Continue final_cot until the judge accepts an output or retries run out
+
+        If the deadline expires, the last judged result (or else the partial
+        output) is returned with the timeout reason as its error.
+        """
+        max_judge_retries = self.config.get('max_judger_retries', 10)
+        refusal_early_stop = self.config.get('refusal_early_stop', True)
+        partial = ProcessingResult(prompt=prompt)
+
+        try:
+            # Tokenize final_cot once for all judge retries
+            final_cot_ids = self.llm.encode(final_cot, wrap_prompt=False)
+            for judge_attempt in range(max_judge_retries):
+                last_judge_attempt = judge_attempt == max_judge_retries - 1
+
+                # Cancel samples that open with a refusal unless it is the last chance
+                refusal_detector = self._refusal_detector()
+                consumers = list(self.stream_consumers)
+                if refusal_early_stop and not last_judge_attempt:
+                    consumers.append(refusal_detector)
+
+                deadline.begin_stage("final_output")
+                continuation = ""
+                for chunk in self.llm.stream(final_cot_ids, max_new_tokens=2048,
+                                             consumers=consumers, deadline=deadline):
+                    continuation += chunk
+                output = final_cot + continuation
+                if partial.score is None:
+                    partial.harmful_cot_output = output
+                deadline.check()
+
+                if refusal_detector.detected:
+                    self.logger.info(f"Refusal detected during generation, retrying "
+                                     f"({judge_attempt + 1}/{max_judge_retries})")
+                    continue
+
+                score, refused = self._judge(prompt, output, deadline)
+                if not refused or last_judge_attempt:
                     return ProcessingResult(
                         prompt=prompt,
-                        error=str(e)
+                        harmful_cot_output=output,
+                        score=score,
+                        refused=refused
                     )
 
-        return ProcessingResult(prompt=prompt, error="Max retries exceeded")
+                partial = ProcessingResult(prompt=prompt, harmful_cot_output=output,
+                                           score=score, refused=refused)
+
+                self.logger.info(f"Judge refused output, retrying ({judge_attempt + 1}/{max_judge_retries})")
+
+        except DeadlineExceeded as e:
+            self.logger.warning(f"Prompt {e}, recording partial result")
+            partial.error = str(e)
+            return partial
+
+        return ProcessingResult(prompt=prompt, error="Max judge retries exceeded")
+
+    def _generate_judged_outputs_batched(self, prompts: List[str], final_cots: Dict[int, str],
+                                         deadline: Deadline) -> Tuple[Dict[int, ProcessingResult], List[int]]:
+        """Judge-retry loop for several runs, generating each round as one batch
+
+        Every row has its own refusal detector, so a refusing sample stops
+        decoding on its own and the batch ends once every row has stopped.
+        Runs whose judging fails, or every unfinished run if a batch fails,
+        are returned to be retried.
+        """
+        max_judge_retries = self.config.get('max_judger_retries', 10)
+        refusal_early_stop = self.config.get('refusal_early_stop', True)
+        results: Dict[int, ProcessingResult] = {}
+        failed: List[int] = []
+        partials = {i: ProcessingResult(prompt=prompts[i]) for i in final_cots}
+        pending = list(final_cots)
+
+        try:
+            # Tokenize each final_cot once for all judge retries
+            final_cot_ids = {i: self.llm.encode(final_cots[i], wrap_prompt=False) for i in pending}
+            for judge_attempt in range(max_judge_retries):
+                last_judge_attempt = judge_attempt == max_judge_retries - 1
+
+                # Cancel samples that settle on a refusal unless it is the last chance
+                detectors = [self._refusal_detector() if refusal_early_stop and not last_judge_attempt
+                             else None for _ in pending]
+
+                deadline.begin_stage("final_output")
+                continuations = self.llm.generate_batch(
+                    [final_cot_ids[i] for i in pending], max_new_tokens=2048,
+                    deadline=deadline, consumers=detectors
+                )
+                for i, continuation in zip(pending, continuations):
+                    if partials[i].score is None:
+                        partials[i].harmful_cot_output = final_cots[i] + continuation
+                deadline.check()
+
+                retry = []
+                for i, continuation, detector in zip(pending, continuations, detectors):
+                    if detector is not None and detector.detected:
+                        retry.append(i)
+                        continue
+
+                    output = final_cots[i] + continuation
+                    try:
+                        score, refused = self._judge(prompts[i], output, deadline)
+                    except DeadlineExceeded:
+                        raise
+                    except Exception as e:
+                        self.logger.error(f"Error judging output for run {i + 1}: {e}", exc_info=True)
+                        failed.append(i)
+                        continue
+
+                    result = ProcessingResult(
+                        prompt=prompts[i],
+                        harmful_cot_output=output,
+                        score=score,
+                        refused=refused
+                    )
+                    if not refused or last_judge_attempt:
+                        results[i] = result
+                    else:
+                        partials[i] = result
+                        retry.append(i)
+
+                if not retry:
+                    break
+                self.logger.info(f"{len(retry)}/{len(pending)} outputs refused, retrying "
+                                 f"({judge_attempt + 1}/{max_judge_retries})")
+                pending = retry
+
+        except DeadlineExceeded as e:
+            self.logger.warning(f"Prompt {e}, recording partial results")
+            failed = []
+            for i in final_cots:
+                if i not in results:
+                    partials[i].error = str(e)
+                    results[i] = partials[i]
+        except Exception as e:
+            self.logger.error(f"Error generating outputs: {e}", exc_info=True)
+            failed = [i for i in final_cots if i not in results]
+
+        for i in final_cots:
+            if i not in results and i not in failed:
+                results[i] = ProcessingResult(prompt=prompts[i], error="Max judge retries exceeded")
+        return results, failed
+
+    def _judge(self, prompt: str, output: str, deadline: Deadline) -> Tuple[Optional[float], Optional[bool]]:
+        """Score output within the deadline, returning the score and whether it was refused"""
+        deadline.begin_stage("judge")
+        try:
+            score = self.judge.evaluate(prompt, output, timeout=deadline.remaining())
+        except Exception:
+            # Report request timeouts caused by the deadline as such
+            deadline.check()
+            raise
+        deadline.check()
+        refused = (score == 0) if score is not None else None
+        return score, refused
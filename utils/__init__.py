@@ -1,6 +1,8 @@
 """Utility modules"""
 from .csv_handler import ResultsCSVWriter
+from .deadline import Deadline, DeadlineExceeded
 from .logging_config import setup_logging
+from .memory import peak_rss_mb
 from .prompt_templates import PromptTemplates
 
-__all__ = ['ResultsCSVWriter', 'setup_logging', 'PromptTemplates']
+__all__ = ['ResultsCSVWriter', 'Deadline', 'DeadlineExceeded', 'setup_logging', 'peak_rss_mb', 'PromptTemplates']
@@ -0,0 +1,65 @@
+"""Per-prompt deadlines, stage timeouts and cooperative cancellation"""
+import threading
+import time
+from typing import Optional
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a prompt runs out of time or is cancelled"""
+
+    def __init__(self, stage: str, reason: str):
+        self.stage = stage
+        self.reason = reason
+        super().__init__(f"timeout: {reason} during {stage}")
+
+
+class Deadline:
+    """Wall-clock budget for one prompt, with an optional cap on each stage
+
+    Long-running work polls ``expired()`` or ``remaining()`` to stop early;
+    ``cancel()`` makes every later poll report expiry. A timeout of 0 disables
+    that limit.
+    """
+
+    def __init__(self, timeout: float = 0, stage_timeout: float = 0):
+        self.expires_at = time.monotonic() + timeout if timeout else None
+        self.stage_timeout = stage_timeout
+        self.stage = "start"
+        self.stage_expires_at = self.expires_at
+        self._cancelled = threading.Event()
+
+    def begin_stage(self, stage: str):
+        """Start timing a new stage, capped by the overall deadline"""
+        self.stage = stage
+        self.stage_expires_at = self.expires_at
+        if self.stage_timeout:
+            stage_end = time.monotonic() + self.stage_timeout
+            if self.stage_expires_at is None or stage_end < self.stage_expires_at:
+                self.stage_expires_at = stage_end
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left for the current stage, or None when unlimited"""
+        if self._cancelled.is_set():
+            return 0.0
+        if self.stage_expires_at is None:
+            return None
+        return max(self.stage_expires_at - time.monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        return self.remaining() == 0.0
+
+    def cancel(self):
+        """Cancel all remaining work for this prompt"""
+        self._cancelled.set()
+
+    def check(self):
+        """Raise DeadlineExceeded if the current stage is out of time"""
+        if not self.expired():
+            return
+        if self._cancelled.is_set():
+            reason = "cancelled"
+        elif self.expires_at is not None and time.monotonic() >= self.expires_at:
+            reason = "prompt deadline exceeded"
+        else:
+            reason = "stage timeout exceeded"
+        raise DeadlineExceeded(self.stage, reason)
@@ -1,33 +1,132 @@
 """Logging configuration"""
+import atexit
+import itertools
+import json
 import logging
+import logging.handlers
+import queue
 import sys
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
+# Logger for large payloads (full prompts, responses, judge output)
+ARTIFACT_LOGGER = "cot_mirage.artifacts"
 
-def setup_logging(log_file: Optional[str] = None, level: str = "INFO"):
-    """Configure logging for the application"""
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as one JSON object, including any structured extras"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that leaves all message formatting to the listener thread
+
+    The stock handler formats every record before enqueueing it, which puts
+    the cost of large messages back on the calling thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class _PayloadSampler(logging.Filter):
+    """Keeps one in every ``sample_every`` records and truncates their string arguments"""
+
+    def __init__(self, sample_every: int, max_chars: int):
+        super().__init__()
+        self.sample_every = max(sample_every, 1)
+        self.max_chars = max_chars
+        self._counter = itertools.count()
+
+    def _truncate(self, value):
+        if isinstance(value, str) and len(value) > self.max_chars:
+            return f"{value[:self.max_chars]}... [{len(value) - self.max_chars} chars truncated]"
+        return value
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if next(self._counter) % self.sample_every:
+            return False
+        if isinstance(record.args, tuple):
+            record.args = tuple(self._truncate(arg) for arg in record.args)
+        return True
+
+
+def _start_listener(handlers: List[logging.Handler]) -> queue.SimpleQueue:
+    """Start a background listener writing to handlers and return its queue"""
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return log_queue
+
+
+def setup_logging(log_file: Optional[str] = None, level: str = "INFO",
+                  json_format: bool = False,
+                  max_bytes: int = 50 * 1024 * 1024,
+                  backup_count: int = 5,
+                  artifact_log: Optional[str] = None,
+                  artifact_sample_every: int = 10,
+                  artifact_max_chars: int = 2000):
+    """Configure logging for the application
+
+    Records are handed to a queue and written by a background listener, so
+    log I/O stays off the processing loop. Log files rotate by size. Records
+    on the artifact logger go in full to ``artifact_log`` when it is set;
+    otherwise only a truncated sample reaches the main log.
+    """
 
     # Create logs directory if needed
-    if log_file:
-        log_path = Path(log_file)
-        log_path.parent.mkdir(parents=True, exist_ok=True)
+    for path in (log_file, artifact_log):
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
 
     # Configure logging format
     log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    formatter = JsonFormatter() if json_format else logging.Formatter(log_format)
 
     # Configure handlers
     handlers = [logging.StreamHandler(sys.stdout)]
     if log_file:
-        handlers.append(logging.FileHandler(log_file))
+        handlers.append(logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    log_queue = _start_listener(handlers)
 
     # Apply configuration
     logging.basicConfig(
         level=getattr(logging, level.upper()),
-        format=log_format,
-        handlers=handlers
+        handlers=[_DeferredQueueHandler(log_queue)]
     )
 
+    # Route large payloads to their own log, or sample them into the main one
+    artifact_logger = logging.getLogger(ARTIFACT_LOGGER)
+    artifact_logger.propagate = False
+    if artifact_log:
+        artifact_handler = logging.handlers.RotatingFileHandler(
+            artifact_log, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'
+        )
+        artifact_handler.setFormatter(JsonFormatter())
+        artifact_logger.addHandler(_DeferredQueueHandler(_start_listener([artifact_handler])))
+    else:
+        sampled_handler = _DeferredQueueHandler(log_queue)
+        sampled_handler.addFilter(_PayloadSampler(artifact_sample_every, artifact_max_chars))
+        artifact_logger.addHandler(sampled_handler)
+
     # Reduce noise from external libraries
     logging.getLogger("urllib3").setLevel(logging.WARNING)
     logging.getLogger("requests").setLevel(logging.WARNING)